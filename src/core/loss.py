@@ -58,3 +58,53 @@ class OcclusionRegularizer():
             case _:
                 raise ValueError(f'Unknown occlusion regularizer type: {self.type}')
         return weights
+
+class FrequencyRegularizer():
+    """
+    Norm penalty on the weights of a model to suppress high frequencies.
+    ----------------------------------------------------------------------------
+    """
+    def __init__(self, model: torch.nn.Module, reg: str = 'l1'):
+        """
+        Initializes the frequency regularizer. Penalized weights are selected
+        once, since parameters are updated in place during training.
+        ------------------------------------------------------------------------
+        Args:
+            model (torch.nn.Module): model whose weights are penalized
+            reg (str): norm used to penalize the weights, 'l1' or 'l2'
+        """
+        self.params = [param for name, param in model.named_parameters()
+                       if 'weight' in name and param.shape[0] > 3]
+        assert len(self.params) > 0, 'model has no weights to regularize'
+        match reg:
+            case 'l1':
+                self.ord = 1
+            case 'l2':
+                self.ord = 2
+            case _:
+                raise ValueError(f'Unknown frequency regularizer norm: {reg}')
+        # weight index of every flattened element, for per-weight L2 norms
+        sizes = torch.tensor([p.numel() for p in self.params])
+        self.segments = torch.repeat_interleave(
+                torch.arange(len(self.params)),
+                sizes
+        ).to(self.params[0].device)
+
+    def __call__(self) -> Tensor:
+        """
+        Computes the sum of weight norms.
+        ------------------------------------------------------------------------
+        Returns:
+            Tensor: frequency regularization term of shape ()
+        """
+        # flatten all weights into one vector to reduce them in a few kernels
+        w = torch.cat([p.reshape(-1) for p in self.params])
+        if self.ord == 1:
+            # sum of L1 norms is the L1 norm of the concatenated weights
+            reg = w.abs().sum()
+        else:
+            sq = torch.zeros(len(self.params), dtype=w.dtype, device=w.device)
+            reg = sq.index_add_(0, self.segments, w.square()).sqrt().sum()
+        assert reg.requires_grad or not torch.is_grad_enabled(), \
+                'frequency regularizer is detached from the model weights'
+        return reg
@@ -1,6 +1,10 @@
 # standard library modules
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
 import json
 import os
+import tempfile
 from typing import Tuple, List, Union, Callable
 
 # third-party modules
@@ -9,11 +13,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 from numpy import ndarray
 import torch
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, kmeans_plusplus
 from torch import Tensor
 from torch.utils.data import Dataset
 from torchvision.transforms import GaussianBlur, Resize
 
+# optional modules
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 # custom modules
 from utils import utilities as U
 
@@ -60,6 +71,212 @@ def pose_from_spherical(
     
     return pose
 
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def lloyd3d(
+        x: ndarray,
+        centers: ndarray,
+        max_iter: int
+    ) -> ndarray:
+        """
+        Lloyd's algorithm specialized for 3-D points. Runs until assignments
+        stop changing or max_iter iterations are reached. Empty clusters are 
+        moved to the points farthest from their own centers. Distances computed
+        in the last assignment step are reused to select the point closest to 
+        every center.
+        ------------------------------------------------------------------------
+        Args:
+            x (ndarray): [N, 3]. Points
+            centers (ndarray): [K, 3]. Initial cluster centers
+            max_iter (int): maximum number of iterations
+        Returns:
+            idxs (ndarray): [K,]. Index of the closest point to every center,
+                            N for clusters left empty
+        """
+        n, k = x.shape[0], centers.shape[0]
+        labels = np.full(n, -1, dtype=np.int64)
+        dists = np.empty(n) # squared distances to own center
+        for it in range(max_iter):
+            # assignment step
+            changed = 0
+            for i in prange(n):
+                best, best_d = 0, 0.
+                for c in range(k):
+                    dx = x[i, 0] - centers[c, 0]
+                    dy = x[i, 1] - centers[c, 1]
+                    dz = x[i, 2] - centers[c, 2]
+                    d = dx*dx + dy*dy + dz*dz
+                    if c == 0 or d < best_d:
+                        best, best_d = c, d
+                dists[i] = best_d
+                if labels[i] != best:
+                    labels[i] = best
+                    changed += 1
+            sums = np.zeros((k, 3))
+            counts = np.zeros(k)
+            for i in range(n):
+                c = labels[i]
+                sums[c, 0] += x[i, 0]
+                sums[c, 1] += x[i, 1]
+                sums[c, 2] += x[i, 2]
+                counts[c] += 1
+            n_empty = np.count_nonzero(counts == 0)
+            if (changed == 0 and n_empty == 0) or it == max_iter - 1:
+                break
+
+            # update step
+            for c in range(k):
+                if counts[c] > 0:
+                    centers[c, 0] = sums[c, 0] / counts[c]
+                    centers[c, 1] = sums[c, 1] / counts[c]
+                    centers[c, 2] = sums[c, 2] / counts[c]
+                else:
+                    # move empty cluster to the farthest point not yet taken
+                    far = np.argmax(dists)
+                    centers[c] = x[far]
+                    dists[far] = -1.
+
+        # closest point to every center, ties resolve to the lowest index
+        idxs = np.full(k, n, dtype=np.int64)
+        for i in range(n):
+            c = labels[i]
+            if idxs[c] == n or dists[i] < dists[idxs[c]]:
+                idxs[c] = i
+
+        return idxs
+
+def lloyd_torch(
+    x: ndarray,
+    centers: ndarray,
+    max_iter: int,
+    device: torch.device = torch.device('cuda')
+) -> ndarray:
+    """
+    Lloyd's algorithm on torch tensors, meant to run on the GPU. Runs until
+    assignments stop changing or max_iter iterations are reached. Empty 
+    clusters are moved to the points farthest from their own centers. Distances
+    computed in the last assignment step are reused to select the point closest
+    to every center.
+    ---------------------------------------------------------------------------- 
+    Args:
+        x (ndarray): [N, 3]. Points
+        centers (ndarray): [K, 3]. Initial cluster centers
+        max_iter (int): maximum number of iterations
+        device (torch.device): device to run on
+    Returns:
+        idxs (ndarray): [K,]. Index of the closest point to every center, N for
+                        clusters left empty
+    """
+    x = torch.from_numpy(x).to(device)
+    centers = torch.from_numpy(centers).to(device)
+    n, k = x.shape[0], centers.shape[0]
+    labels = None
+    for it in range(max_iter):
+        # assignment step
+        dists, new_labels = torch.cdist(x, centers).min(dim=1)
+        counts = torch.bincount(new_labels, minlength=k)
+        n_empty = int((counts == 0).sum())
+        converged = labels is not None and torch.equal(new_labels, labels)
+        labels = new_labels
+        if (converged and n_empty == 0) or it == max_iter - 1:
+            break
+
+        # update step
+        sums = torch.zeros_like(centers).index_add_(0, labels, x)
+        centers = sums / counts.clamp_min(1).unsqueeze(1)
+        if n_empty > 0:
+            # move empty clusters to the farthest points
+            far = torch.topk(dists, n_empty).indices
+            centers[counts == 0] = x[far]
+
+    # closest point to every center, ties resolve to the lowest index
+    best = torch.full_like(centers[:, 0], float('inf'))
+    best = best.scatter_reduce(0, labels, dists, reduce='amin')
+    is_best = dists == best[labels]
+    idxs = torch.full((k,), n, dtype=torch.long, device=device)
+    idxs = idxs.scatter_reduce(
+            0, 
+            labels[is_best], 
+            torch.arange(n, device=device)[is_best],
+            reduce='amin'
+    )
+
+    return idxs.cpu().numpy()
+
+def kmeans_views(x: ndarray, n_views: int) -> ndarray:
+    """
+    Clusters 3-D camera positions with K-means and selects the closest view to
+    every cluster center. A single run of Lloyd's algorithm seeded with 
+    k-means++ is executed on the GPU if available, or with a 3-D numba kernel 
+    otherwise. Without either, or if the single run still leaves a cluster 
+    empty, it falls back to scikit-learn.
+    ---------------------------------------------------------------------------- 
+    Args:
+        x (ndarray): [N, 3]. Camera positions
+        n_views (int): number of views to select
+    Returns:
+        idxs (ndarray): [n_views,]. Indices of the selected views
+    Raises:
+        ValueError: if there are fewer distinct camera positions than n_views
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n_unique = len(np.unique(x, axis=0))
+    if n_unique < n_views:
+        raise ValueError(
+                f'Cannot select {n_views} views from {n_unique} distinct '
+                f'camera positions'
+        )
+
+    use_cuda = torch.cuda.is_available()
+    if use_cuda or HAS_NUMBA:
+        x = np.ascontiguousarray(x)
+        centers, _ = kmeans_plusplus(x, n_views) # k-means++ seeding
+        if use_cuda:
+            idxs = lloyd_torch(x, centers, 300)
+        else:
+            idxs = lloyd3d(x, centers, 300)
+        # empty clusters are marked with an out-of-range index
+        if np.all(idxs < len(x)):
+            return idxs
+
+    model = KMeans(n_clusters=n_views,  n_init=10).fit(x)
+    labels = model.labels_
+    # compute squared distances to cluster centers
+    d = x - model.cluster_centers_[labels]
+    dists = np.einsum('ij,ij->i', d, d)
+    # choose the closest view for every cluster center
+    idxs = closest_views(dists, labels, n_views)
+
+    return idxs
+
+def closest_views(
+    dists: ndarray,
+    labels: ndarray,
+    n_clusters: int
+) -> ndarray:
+    """
+    Selects the closest sample to the center of every cluster. Samples are
+    sorted by (label, distance) so that the first entry of each label segment
+    is the representative of its cluster.
+    ---------------------------------------------------------------------------- 
+    Args:
+        dists (ndarray): [N,]. Distances from samples to their cluster centers
+        labels (ndarray): [N,]. Cluster label of every sample
+        n_clusters (int): number of clusters
+    Returns:
+        idxs (ndarray): [n_clusters,]. Indices of the closest samples, N for
+                        clusters without samples
+    """
+    order = np.lexsort((dists, labels)) # sort by label, then by distance
+    sorted_labels = labels[order]
+    # starting positions of every label segment
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_labels)) + 1))
+    # empty clusters get an out-of-range index instead of garbage
+    idxs = np.full((n_clusters,), len(dists), dtype=int)
+    idxs[sorted_labels[starts]] = order[starts]
+
+    return idxs
+
 
 class SyntheticRealistic(Dataset):
     """
@@ -76,6 +293,7 @@ class SyntheticRealistic(Dataset):
             n_imgs: int = None,
             img_mode: bool = False,
             white_bkgd: bool = False,
+            cache: bool = False,
     ) -> None:
         """
         Initialize the dataset.
@@ -86,6 +304,7 @@ class SyntheticRealistic(Dataset):
             n_imgs (int): number of training images
             white_bkgd (bool): whether to use white background
             img_mode (bool): wether to iterate over rays or images
+            cache (bool): whether to keep decoded images in the dataset folder
         Returns:
             None
         """
@@ -96,16 +315,17 @@ class SyntheticRealistic(Dataset):
         self.far = 6.0
         self.ndc = False
         self.img_mode = img_mode
+        self.cache = cache
 
         imgs, poses, hwf = self.__load() # load imgs, poses and intrinsics
         self.__build_path() # build path to render sample video
         self.hwf = hwf
 
         # compute background color
+        rgb, alpha = imgs[..., :3], imgs[..., 3:]
         if white_bkgd:
-            imgs = imgs[..., :3] * imgs[..., -1:] + (1. - imgs[..., -1:])
-        else:
-            imgs = imgs[..., :3]
+            rgb.mul_(alpha).add_(1.).sub_(alpha) # in-place rgb*a + (1 - a)
+        imgs = rgb
 
         # choose random index for visual comparisons
         idx = np.random.randint(0, imgs.shape[0])
@@ -115,15 +335,7 @@ class SyntheticRealistic(Dataset):
         # apply K-means to draw N views and ensure maximum scene coverage
         x = poses[:, :3, 3]
         x = x[x[:, -1] > 0] # remove poses with negative z-coordinates
-        kmeans = KMeans(n_clusters=n_imgs,  n_init=10).fit(x) # kmeans model
-        labels = kmeans.labels_
-        # compute distances to cluster centers
-        dists = np.linalg.norm(x - kmeans.cluster_centers_[labels], axis=1)
-        # choose the closest view for every cluster center
-        idxs = np.empty((n_imgs,), dtype=int) # array for indices of views
-        for i in range(n_imgs):
-            cluster_dists = np.where(labels == i, dists, np.inf)
-            idxs[i] = np.argmin(cluster_dists)
+        idxs = kmeans_views(x, n_imgs) # closest view to every cluster center
 
         self.imgs = imgs[idxs]
         self.poses = poses[idxs]
@@ -133,6 +345,9 @@ class SyntheticRealistic(Dataset):
         if not self.img_mode:
             # split images into individual per-ray samples
             self.__build_data(self.imgs, self.poses, self.hwf)
+        elif torch.cuda.is_available():
+            # page-locked for fast copies
+            self.imgs = self.imgs.pin_memory()
 
 
     def __len__(self) -> int:
@@ -146,7 +361,7 @@ class SyntheticRealistic(Dataset):
         if self.img_mode:
             return len(self.imgs)
 
-        return len(self.rgb)
+        return self.rays.shape[1]
 
     def __getitem__(self, idx: int) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
         """Get a training sample by index.
@@ -161,7 +376,9 @@ class SyntheticRealistic(Dataset):
         if self.img_mode:
             return self.imgs[idx], self.poses[idx]
 
-        return self.rays_o[idx], self.rays_d[idx], self.rgb[idx]
+        ray_o, ray_d = self.rays[:, idx].view(2, 3)
+        rgb = self.rgb[:, idx].float().mul_(1. / 255.)
+        return ray_o, ray_d, rgb
 
     def __build_data(
             self,
@@ -178,13 +395,16 @@ class SyntheticRealistic(Dataset):
             poses (Tensor): [N, 4, 4]. Camera poses
             hwf (Tuple): [3,]. Camera intrinsics
         """
-        # compute ray origins and directions
-        rays = torch.stack([torch.cat(U.get_rays(p, hwf), -1) 
-                            for p in poses], 0)
-        rays = rays.reshape(-1, 6)
-        self.rays_o = rays[:, :3] # ray origins
-        self.rays_d = rays[:, 3:] # ray directions
-        self.rgb = imgs.reshape(-1, 3) # reshape to [N, 3]
+        # compute ray origins and directions for all poses at once
+        rays_o, rays_d = U.get_rays(poses, hwf)
+        # pack ray origins and directions channel-first
+        self.rays = torch.cat([
+            rays_o.reshape(-1, 3).T,
+            rays_d.reshape(-1, 3).T
+        ], dim=0).contiguous() # [6, N]
+        # store pixel colors with 8-bit precision
+        self.rgb = imgs.reshape(-1, 3).T.mul(255.).round_().to(torch.uint8)
+        self.rgb = self.rgb.contiguous() # [3, N]
 
     def __downsample(
             self, 
@@ -213,6 +433,71 @@ class SyntheticRealistic(Dataset):
 
         return new_imgs, new_hwf
 
+    @staticmethod
+    def __decode(fnames: List[str]) -> ndarray:
+        """
+        Decodes images into a single 8-bit buffer.
+        ------------------------------------------------------------------------
+        Args:
+            fnames (List[str]): image filenames
+        Returns:
+            imgs (ndarray): [N, H, W, 4]. RGBa images
+        """
+        # queue readahead for every file at once so the device sees a deep
+        # request queue instead of one blocking read per image
+        if hasattr(os, 'posix_fadvise'):
+            for fname in fnames:
+                fd = os.open(fname, os.O_RDONLY)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                os.close(fd)
+        # decode first image to preallocate the 8-bit image buffer
+        img = iio.imread(fnames[0]) # RGBa image
+        imgs = np.empty((len(fnames), *img.shape), dtype=np.uint8)
+        imgs[0] = img
+        # decode remaining images in parallel, map preserves frame order
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for i, img in enumerate(executor.map(iio.imread, fnames[1:]), 1):
+                imgs[i] = img
+
+        return imgs
+
+    @staticmethod
+    def __write_cache(imgs: ndarray, cache_path: str, prefix: str) -> None:
+        """
+        Stores decoded images and removes caches of stale images. Images are
+        written to a unique temporary file first, so concurrent processes never
+        leave a partial cache behind.
+        ------------------------------------------------------------------------
+        Args:
+            imgs (ndarray): [N, H, W, 4]. Decoded 8-bit images
+            cache_path (str): path of the cache file
+            prefix (str): path prefix shared by all caches of the split
+        Returns:
+            None
+        """
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                    dir=os.path.dirname(cache_path), 
+                    suffix='.tmp', 
+                    delete=False
+            ) as f:
+                tmp_path = f.name
+                np.save(f, imgs)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # read-only dataset directory or full disk, skip caching
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        for stale in glob.glob(prefix + '*.npy'):
+            if stale != cache_path:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass # already removed by a concurrent process
+
     def __load(self) -> Tuple[Tensor, Tensor, Tuple[int, int, float]]:
         """
         Loads the dataset. It loads images, camera poses and intrinsics.
@@ -227,22 +512,33 @@ class SyntheticRealistic(Dataset):
         scene = self.scene
         path = os.path.join('..', 'datasets', 'synthetic', scene)
         # load JSON file
-        with open(os.path.join(path, f'transforms_{self.split}.json'), 'r') as f:
+        meta_path = os.path.join(path, f'transforms_{self.split}.json')
+        with open(meta_path, 'r') as f:
             meta = json.load(f) # metadata
 
-        # load images and camera poses
-        imgs = []
-        poses = []
-        for frame in meta['frames']:
-            # camera pose
-            poses.append(np.array(frame['transform_matrix']))
-            # frame image
-            fname = os.path.join(path, frame['file_path'] + '.png')
-            imgs.append(iio.imread(fname)) # RGBa image
-
-        # convert to numpy arrays
+        # camera poses
+        poses = [np.asarray(frame['transform_matrix']) 
+                 for frame in meta['frames']]
+        fnames = [os.path.join(path, frame['file_path'] + '.png')
+                  for frame in meta['frames']]
+        if not self.cache:
+            imgs = SyntheticRealistic.__decode(fnames)
+        else:
+            # cache is keyed by path, mtime and size of metadata and images
+            key = hashlib.sha1()
+            for fname in [meta_path] + fnames:
+                stat = os.stat(fname)
+                key.update(f'{fname}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+            prefix = os.path.join(path, f'_{self.split}_cache_')
+            cache_path = prefix + key.hexdigest()[:16] + '.npy'
+            if os.path.exists(cache_path):
+                imgs = np.load(cache_path)
+            else:
+                imgs = SyntheticRealistic.__decode(fnames)
+                SyntheticRealistic.__write_cache(imgs, cache_path, prefix)
+
+        # convert to numpy array
         poses = np.stack(poses, axis=0).astype(np.float32)
-        imgs = (np.stack(imgs, axis=0) / 255.).astype(np.float32)
 
         # compute image height, width and camera's focal length
         H, W = imgs.shape[1:3]
@@ -250,9 +546,9 @@ class SyntheticRealistic(Dataset):
         focal = 0.5 * W / np.tan(0.5 * fov_x)
         hwf = (H, W, focal.item())
 
-        # create tensors
+        # create tensors, images are scaled to [0, 1] in a single pass
         poses = torch.from_numpy(poses)
-        imgs = torch.from_numpy(imgs)
+        imgs = torch.from_numpy(imgs).float().mul_(1. / 255.)
 
         return imgs, poses, hwf
 
@@ -342,17 +638,14 @@ class LLFF(Dataset):
             poses (Tensor): [N, 3, 5]. Re-centered camera poses
         """
         poses_ = poses.copy()
-        bottom = np.reshape([0, 0, 0, 1.], [1, 4]) # last row of camera matrix
         c2w = LLFF.__avg_pose(poses) # average pose
-        c2w = np.concatenate([c2w[:3, :4], bottom], axis=-2) # center to world
-        bottom = np.tile(np.reshape(bottom, [1, 1, 4]), [poses.shape[0], 1, 1])
-        poses = np.concatenate([poses[:, :3, :4], bottom], -2) # camera to world
-        
-        poses = np.linalg.inv(c2w) @ poses
-        poses_[:, :3, :4] = poses[:, :3, :4]
-        poses = poses_
+        R, center = c2w[:, :3], c2w[:, 3] # center to world rotation and origin
+
+        # apply the rigid inverse of the average pose to all poses at once
+        poses_[:, :3, :3] = R.T @ poses[:, :3, :3]
+        poses_[:, :3, 3] = (poses[:, :3, 3] - center) @ R
 
-        return poses
+        return poses_
 
     @staticmethod
     def __load(
@@ -391,10 +684,18 @@ class LLFF(Dataset):
                  if f.endswith(('JPG', 'jpg', 'png'))]
         assert len(paths) == poses.shape[-1], \
                 'Mismath between the number of images and poses'
-        imgs = np.stack([iio.imread(p)[..., :3] / 255. for p in paths], axis=0)
+        # decode first image to preallocate the image buffer
+        img = iio.imread(paths[0])[..., :3]
+        H, W, _ = img.shape
+        imgs = np.empty((len(paths), H, W, 3), dtype=np.float32)
+        imgs[0] = img
+        # decode remaining images in parallel, map preserves path order
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for i, img in enumerate(executor.map(iio.imread, paths[1:]), 1):
+                imgs[i] = img[..., :3]
+        np.multiply(imgs, 1. / 255., out=imgs) # scale to [0, 1] in place
 
         # modify camera poses
-        H, W, _ = iio.imread(paths[0]).shape
         poses[:2, 4, :] = np.array([H, W]).reshape([2, 1])
         poses[2, 4, :] = poses[2, 4, :] * 1. / factor
         # correct poses ordering
@@ -460,15 +761,7 @@ class LLFF(Dataset):
         assert n_imgs <= poses.shape[0], "Number of images {n_imgs} exceeds" + \
                                          "the number of poses {poses.shape[0]}"
         x = poses[:, :3, 3]
-        kmeans = KMeans(n_clusters=n_imgs,  n_init=10).fit(x) # kmeans model
-        labels = kmeans.labels_
-        # compute distances to cluster centers
-        dists = np.linalg.norm(x - kmeans.cluster_centers_[labels], axis=1)
-        # choose the closest view for every cluster center
-        idxs = np.empty((n_imgs,), dtype=int) # array for indices of views
-        for i in range(n_imgs):
-            cluster_dists = np.where(labels == i, dists, np.inf)
-            idxs[i] = np.argmin(cluster_dists)
+        idxs = kmeans_views(x, n_imgs) # closest view to every cluster center
 
         # choose random index for visual comparisons
         idx = np.random.randint(0, imgs.shape[0])
@@ -495,6 +788,9 @@ class LLFF(Dataset):
         if not self.img_mode:
             # split images into individual per-ray samples
             self.__build_data()
+        elif torch.cuda.is_available():
+            # page-locked for fast copies
+            self.imgs = self.imgs.pin_memory()
 
     def __build_data(self) -> None:
         """
@@ -502,13 +798,10 @@ class LLFF(Dataset):
         ------------------------------------------------------------------------
         """
         H, W, _ = self.hwf
-        self.rgb = self.imgs.reshape(-1, 3) # reshape to pixels
-        # get rays
-        rays = torch.stack([torch.cat(U.get_rays(p, self.hwf), -1)
-                            for p in self.poses], 0)
-        rays = rays.reshape(-1, 6)
-        rays_o = rays[:, :3] # ray origins
-        rays_d = rays[:, 3:] # ray directions
+        # get rays for all poses at once
+        rays_o, rays_d = U.get_rays(self.poses, self.hwf)
+        rays_o = rays_o.reshape(-1, 3) # ray origins
+        rays_d = rays_d.reshape(-1, 3) # ray directions
 
         # map to ndc if necessary
         if self.ndc:
@@ -525,8 +818,11 @@ class LLFF(Dataset):
             aabb = torch.tensor([-1.5, -1.5, -1.5, 1.5, 1.5, 1.5])
 
         self.aabb = aabb
-        self.rays_o = rays_o
-        self.rays_d = rays_d
+        # pack ray origins and directions channel-first
+        self.rays = torch.cat([rays_o.T, rays_d.T], dim=0).contiguous() # [6, N]
+        # store pixel colors with 8-bit precision
+        self.rgb = self.imgs.reshape(-1, 3).T.mul(255.).round_()
+        self.rgb = self.rgb.to(torch.uint8).contiguous() # [3, N]
 
     def __build_path(
             self,
@@ -601,11 +897,13 @@ class LLFF(Dataset):
         if self.img_mode:
             return self.imgs[idx], self.poses[idx]
 
-        return self.rays_o[idx], self.rays_d[idx], self.rgb[idx]
+        ray_o, ray_d = self.rays[:, idx].view(2, 3)
+        rgb = self.rgb[:, idx].float().mul_(1. / 255.)
+        return ray_o, ray_d, rgb
 
     def __len__(self) -> int:
         """Returns the number of training samples."""
         if self.img_mode:
             return self.imgs.shape[0]
 
-        return self.rays_o.shape[0]
+        return self.rays.shape[1]
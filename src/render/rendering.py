@@ -30,6 +30,7 @@ def render_rays(
         train: bool = False,
         white_bkgd: bool = False,
         render_step_size: float = 5e-3,
+        alpha_thre: float = 0.,
         device: torch.device = torch.device('cpu')
 ) -> Tuple[Tensor]:
     """Renders rays using a given NeRF model.
@@ -42,6 +43,7 @@ def render_rays(
         train: Whether to train model
         white_bkgd: Whether to use white background
         render_step_size: Rendering step size
+        alpha_thre: Opacity threshold below which samples are skipped
         device: Device to use for rendering
     Returns:
         rgb: (n_rays, 3)-shape tensor containing RGB values
@@ -59,7 +61,7 @@ def render_rays(
         to = rays_o[ray_indices]
         td = rays_d[ray_indices]
         x = to + td * (t_starts + t_ends)[:, None] / 2.0
-        sigmas = model(x)
+        sigmas = model(x).float() # full precision under autocast
 
         return sigmas.squeeze(-1)
 
@@ -68,6 +70,7 @@ def render_rays(
             sigma_fn=sigma_fn,
             render_step_size=render_step_size,
             stratified=train,
+            alpha_thre=alpha_thre,
             near_plane=0.,
             far_plane=1e10
     )
@@ -76,7 +79,7 @@ def render_rays(
             to = rays_o[ray_indices]
             td = rays_d[ray_indices]
             x = to + td * (t_starts + t_ends)[:, None] / 2.0
-            out = model(x, td)
+            out = model(x, td).float() # full precision under autocast
             rgbs = out[..., :3]
             sigmas = out[..., -1]
 
@@ -88,33 +91,142 @@ def render_rays(
             requires_grad=train
     )
 
-    try:
-        output = rendering(
-                t_starts,
-                t_ends,
-                ray_indices,
-                n_rays=len(rays_o),
-                rgb_sigma_fn=rgb_sigma_fn,
-                render_bkgd=render_bkgd
-        )
-    except AssertionError as e:
-        output = (
-                torch.ones_like(rays_o) * white_bkgd,
+    def background():
+        # no samples to render, a forward pass on zero samples still puts every
+        # parameter in the graph so data parallel gradient syncs do not stall
+        zero = model(rays_o[:0], rays_d[:0]).float().sum() * 0.
+        return (
+                torch.ones_like(rays_o) * white_bkgd + zero,
                 None,
                 torch.zeros_like(rays_o[:, 0].unsqueeze(1), dtype=torch.float32),
-                None,
+                {'sigmas': torch.zeros((0,), device=device)},
         )
 
+    # nerfacc does not fail on empty samples, so check for them explicitly
+    if t_starts.shape[0] == 0:
+        output = background()
+    else:
+        try:
+            output = rendering(
+                    t_starts,
+                    t_ends,
+                    ray_indices,
+                    n_rays=len(rays_o),
+                    rgb_sigma_fn=rgb_sigma_fn,
+                    render_bkgd=render_bkgd
+            )
+        except AssertionError as e:
+            output = background()
+
     t_vals = (t_starts + t_ends) / 2.0
 
     return output, ray_indices, t_vals
 
 
-def render_frame(
+class OccupancyEvaluator():
+    """
+    Occupancy evaluation function for OccGridEstimator that stops querying the
+    model on cells that stayed empty for several consecutive grid updates.
+    ----------------------------------------------------------------------------
+    """
+    def __init__(
+            self,
+            model: nn.Module,
+            estimator: OccGridEstimator,
+            render_step_size: float = 5e-3,
+            occ_thre: float = 1e-2,
+            ema_decay: float = 0.95,
+            patience: int = 2,
+            reprobe: int = 8,
+            warmup_steps: int = 256,
+            n: int = 16,
+            autocast: bool = False
+    ) -> None:
+        """
+        Initializes the occupancy evaluator.
+        ------------------------------------------------------------------------
+        Args:
+            model (nn.Module): NeRF model
+            estimator (OccGridEstimator): occupancy grid estimator to update
+            render_step_size (float): rendering step size
+            occ_thre (float): upper bound of the occupancy threshold
+            ema_decay (float): decay of the estimator's occupancy average
+            patience (int): consecutive empty checks before skipping a cell
+            reprobe (int): grid updates between evaluations of skipped cells
+            warmup_steps (int): grid warmup steps, no cell is skipped before
+            n (int): iterations between grid updates
+            autocast (bool): whether to evaluate the model in bfloat16
+        """
+        self.model = model
+        self.estimator = estimator
+        self.render_step_size = render_step_size
+        self.occ_thre = occ_thre
+        self.ema_decay = ema_decay
+        self.patience = patience
+        self.reprobe = reprobe
+        self.warmup_updates = warmup_steps // n
+        self.autocast = autocast
+        # consecutive empty checks of every cell across all levels
+        self.empty_count = torch.zeros(
+                estimator.levels * estimator.cells_per_lvl,
+                dtype=torch.int32,
+                device=estimator.aabbs.device
+        )
+        self.calls = 0 # the estimator evaluates one level per call, in order
+
+    @torch.no_grad()
+    def __call__(self, x: Tensor) -> Tensor:
+        """
+        Computes occupancy values for sample positions within grid cells.
+        ------------------------------------------------------------------------
+        Args:
+            x (Tensor): sample positions of shape (N, 3)
+        Returns:
+            Tensor: occupancy values of shape (N, 1)
+        """
+        lvl = self.calls % self.estimator.levels
+        update = self.calls // self.estimator.levels
+        self.calls += 1
+
+        # map positions to cell indices of the current level
+        aabb = self.estimator.aabbs[lvl]
+        res = self.estimator.resolution
+        ijk = ((x - aabb[:3]) / (aabb[3:] - aabb[:3]) * res).long()
+        ijk = torch.minimum(ijk.clamp_(min=0), res - 1)
+        ids = (ijk[:, 0] * res[1] + ijk[:, 1]) * res[2] + ijk[:, 2]
+        ids += lvl * self.estimator.cells_per_lvl
+
+        # query model only on cells that may still be occupied, skipped cells
+        # are evaluated again periodically in case they became occupied
+        counts = self.empty_count[ids]
+        active = counts < self.patience
+        if update % self.reprobe == 0:
+            active = torch.ones_like(active)
+        occ = torch.zeros((len(x), 1), device=x.device)
+        with torch.autocast(
+                x.device.type, dtype=torch.bfloat16, enabled=self.autocast
+        ):
+            density = self.model(x[active])
+        occ[active] = density.float() * self.render_step_size
+
+        # track empty cells once the grid has warmed up
+        if update >= self.warmup_updates:
+            # same average and threshold the estimator binarizes the grid with
+            occs = self.estimator.occs
+            occ_ema = torch.maximum(occs[ids] * self.ema_decay, occ[:, 0])
+            thre = torch.clamp(occs[occs >= 0].mean(), max=self.occ_thre)
+            empty = occ_ema <= thre
+            counts = torch.where(empty, counts + 1, 0)
+            self.empty_count[ids[active]] = counts[active]
+
+        return occ
+
+
+def render_frames(
         hwf: Tuple[int, int, float],
         near: float,
         far: float,
-        pose: torch.Tensor, 
+        poses: torch.Tensor, 
         chunksize: int,
         estimator: OccGridEstimator,
         model: nn.Module,
@@ -122,17 +234,18 @@ def render_frame(
         ndc: bool = False,
         white_bkgd: bool = False,
         render_step_size: float = 5e-3,
+        alpha_thre: float = 0.,
         device: torch.device = torch.device('cpu')
-) -> torch.Tensor:
+) -> Tuple[torch.Tensor, torch.Tensor]:
     """
-    Render an image from a given pose. Camera rays are chunkified to avoid memo-
-    ry issues.
+    Render a batch of images from given poses. Camera rays of all frames are
+    packed together and chunkified to avoid memory issues.
     ----------------------------------------------------------------------------
     Args:
         hwf: (3,)-shape tuple containing height, width and focal length
         near: Near bound
         far: Far bound
-        pose: Camera pose
+        poses: (N, 4, 4)-shape tensor containing camera poses
         chunksize: Chunk size for rays
         estimator: OccGridEstimator object
         model: NeRF model
@@ -140,13 +253,15 @@ def render_frame(
         train: Whether to train model
         white_bkgd: Whether to use white background
         render_step_size: Rendering step size
+        alpha_thre: Opacity threshold below which samples are skipped
         device: Device to use for rendering
     Returns:
-        img: (H, W, 3)-shape tensor containing RGB values
-        depth_map: (H, W)-shape tensor containing depth values
+        img: (N, H, W, 3)-shape tensor containing RGB values
+        depth_map: (N, H, W)-shape tensor containing depth values
     """
     H, W, _ = hwf
-    rays_o, rays_d = U.get_rays(pose, hwf, device) # compute rays
+    N = poses.shape[0]
+    rays_o, rays_d = U.get_rays(poses, hwf, device) # compute rays
     rays_o, rays_d = rays_o.reshape(-1, 3), rays_d.reshape(-1, 3) # flatten rays
     if ndc:
         # convert rays to normalized device coordinates
@@ -165,8 +280,10 @@ def render_frame(
                 rays_d,
                 estimator,
                 model,
-                white_bkgd,
+                train=train,
+                white_bkgd=white_bkgd,
                 render_step_size=render_step_size,
+                alpha_thre=alpha_thre,
                 device=device,
         )
         (rgb, _, depth, _), *_ = out 
@@ -177,9 +294,63 @@ def render_frame(
     img = torch.cat(img, dim=0)
     depth = torch.cat(depth_map, dim=0).clamp(near, far)
 
-    return img.reshape(H, W, 3), depth.reshape(H, W)
+    return img.reshape(N, H, W, 3), depth.reshape(N, H, W)
         
 
+def render_frame(
+        hwf: Tuple[int, int, float],
+        near: float,
+        far: float,
+        pose: torch.Tensor, 
+        chunksize: int,
+        estimator: OccGridEstimator,
+        model: nn.Module,
+        train: bool = False,
+        ndc: bool = False,
+        white_bkgd: bool = False,
+        render_step_size: float = 5e-3,
+        alpha_thre: float = 0.,
+        device: torch.device = torch.device('cpu')
+) -> torch.Tensor:
+    """
+    Render an image from a given pose. Camera rays are chunkified to avoid memo-
+    ry issues.
+    ----------------------------------------------------------------------------
+    Args:
+        hwf: (3,)-shape tuple containing height, width and focal length
+        near: Near bound
+        far: Far bound
+        pose: Camera pose
+        chunksize: Chunk size for rays
+        estimator: OccGridEstimator object
+        model: NeRF model
+        ndc: Whether to use normalized device coordinates
+        train: Whether to train model
+        white_bkgd: Whether to use white background
+        render_step_size: Rendering step size
+        alpha_thre: Opacity threshold below which samples are skipped
+        device: Device to use for rendering
+    Returns:
+        img: (H, W, 3)-shape tensor containing RGB values
+        depth_map: (H, W)-shape tensor containing depth values
+    """
+    img, depth = render_frames(
+            hwf,
+            near, far, pose[None],
+            chunksize,
+            estimator,
+            model,
+            train=train,
+            ndc=ndc,
+            white_bkgd=white_bkgd,
+            render_step_size=render_step_size,
+            alpha_thre=alpha_thre,
+            device=device
+    )
+
+    return img[0], depth[0]
+
+
 def render_path(
         render_poses: torch.Tensor,
         hwf: Tuple[int, int, float],
@@ -192,6 +363,7 @@ def render_path(
         train: bool = False,
         white_bkgd: bool = False,
         render_step_size: float = 5e-3,
+        alpha_thre: float = 0.,
         device: torch.device = torch.device('cpu')
 ) -> Tuple[torch.Tensor]:
     """Renders a video from a given path of camera poses.
@@ -208,6 +380,7 @@ def render_path(
         train: bool. Whether to train model
         white_bkgd: bool. Whether to use white background
         render_step_size: float. Step size for rendering
+        alpha_thre: float. Opacity threshold below which samples are skipped
         device: torch.device. Device to use for rendering
     Returns:
         frames: [N, H, W, 3]. N rgb frames
@@ -229,6 +402,7 @@ def render_path(
                     ndc=ndc,
                     white_bkgd=white_bkgd,
                     render_step_size=render_step_size,
+                    alpha_thre=alpha_thre,
                     device=device
             )
 
@@ -1,11 +1,15 @@
 # stdlib imports
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 import logging
 import os
 import random
-from typing import List, Tuple, Union, Optional
+import sys
+from typing import Callable, List, Tuple, Union, Optional
+from weakref import WeakKeyDictionary
 
 # third-party imports
+import lpips
 from lpips import LPIPS
 import matplotlib.pyplot as plt
 import nerfacc
@@ -13,13 +17,15 @@ from nerfacc.volrend import rendering
 from nerfacc.estimators.occ_grid import OccGridEstimator
 import numpy as np
 import plotly.graph_objects as go
-from skimage.metrics import structural_similarity as SSIM
 import torch
 from torch import nn
+import torch.distributed as dist
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.optim import Optimizer
-from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data import Dataset
 from torch import Tensor
+from torchmetrics.functional import structural_similarity_index_measure as SSIM
 from tqdm import tqdm
 import wandb
 
@@ -35,6 +41,12 @@ import utils.utilities as U
 
 # GLOBAL VARIABLES
 k = 0 # global step counter
+lpips_cache = WeakKeyDictionary() # LPIPS features of validation ground truth
+log_pool = ThreadPoolExecutor(max_workers=1) # ordered background wandb logging
+# process layout set by torchrun, single process by default
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+rank = int(os.environ.get('RANK', 0))
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
 
 # RANDOM SEED
 seed = 42
@@ -46,14 +58,19 @@ args = P.config_parser() # parse command line arguments
 
 # MODEL INITIALIZATION
 
-def init_models(aabb: int) -> Tuple[nn.Module, OccGridEstimator]:
+def init_models(
+        aabb: int,
+        with_lpips: bool = True
+) -> Tuple[nn.Module, OccGridEstimator, Optional[LPIPS]]:
     """
     Initialize NeRF-like model, occupancy grid estimator, and LPIPS net.
     ----------------------------------------------------------------------------
     Args:
         aabb (int): axis-aligned bounding box
+        with_lpips (bool): whether to build the LPIPS network
     Returns:
-        Tuple[nn.Module, OccGridEstimator, LPIPS]: models
+        Tuple[nn.Module, OccGridEstimator, LPIPS]: models, LPIPS net is None
+                                                   if with_lpips is False
     """
     # keyword args for positional encoding
     kwargs = {
@@ -99,10 +116,130 @@ def init_models(aabb: int) -> Tuple[nn.Module, OccGridEstimator]:
             levels=grid_nlvl
     )
     # initialize LPIPS network
-    lpips_net = LPIPS(net='vgg')
+    lpips_net = LPIPS(net='alex') if with_lpips else None
     
     return model, estimator, lpips_net
 
+# METRICS
+
+def lpips_features(lpips_net: LPIPS, imgs: Tensor) -> List[Tensor]:
+    """
+    Computes unit-normalized LPIPS backbone activations.
+    ----------------------------------------------------------------------------
+    Args:
+        lpips_net (LPIPS): LPIPS network
+        imgs (Tensor): [N, 3, H, W]. Images with values in [0, 1]
+    Returns:
+        List[Tensor]: [N, C, H', W']. Normalized activations of every layer
+    """
+    outs = lpips_net.net(lpips_net.scaling_layer(2. * imgs - 1.))
+
+    return [lpips.normalize_tensor(out) for out in outs]
+
+def lpips_distance(
+        lpips_net: LPIPS,
+        feats: List[Tensor],
+        feats_gt: List[Tensor]
+) -> Tensor:
+    """
+    Computes LPIPS distances from precomputed backbone activations.
+    ----------------------------------------------------------------------------
+    Args:
+        lpips_net (LPIPS): LPIPS network
+        feats (List[Tensor]): normalized activations of predicted images
+        feats_gt (List[Tensor]): normalized activations of ground truth images
+    Returns:
+        Tensor: [N,]. LPIPS distance of every image pair
+    """
+    return sum(lin((f - g) ** 2).mean(dim=(1, 2, 3))
+               for lin, f, g in zip(lpips_net.lins, feats, feats_gt))
+
+# LOGGING
+
+def log_async(fn: Callable, *args) -> None:
+    """
+    Runs a logging call on the background logging thread. Exceptions raised by
+    the call are reported instead of being silently dropped with its future.
+    ----------------------------------------------------------------------------
+    Args:
+        fn (Callable): logging function
+        *args: arguments of the logging function
+    """
+    def report(future):
+        exc = future.exception()
+        if exc is not None:
+            name = getattr(fn, '__name__', repr(fn))
+            logging.error(f"Background logging with {name} failed", 
+                          exc_info=exc)
+
+    log_pool.submit(fn, *args).add_done_callback(report)
+
+def log_cameras(train_set: Dataset) -> None:
+    """
+    Logs an interactive 3D plot of camera positions and the ground truth test
+    image to wandb.
+    ----------------------------------------------------------------------------
+    Args:
+        train_set (Dataset): training set
+    """
+    # interactive 3D plot of camera positions
+    fig = go.Figure(
+            data=[go.Scatter3d(
+                x=train_set.poses[:, 0, 3],
+                y=train_set.poses[:, 1, 3],
+                z=train_set.poses[:, 2, 3],
+                mode='markers',
+                marker=dict(size=7, opacity=0.8, color='red'),
+            )],
+            layout=go.Layout(
+                margin=dict(l=20,r=20, t=20, b=20),
+            )
+    )
+    # set fixed axis scales
+    t = 1 if args.dataset == 'llff' else 5
+    factor = 1 if args.dataset == 'llff' else 0
+    fig.update_layout(
+        scene=dict(
+            xaxis=dict(range=[-t, t]),
+            yaxis=dict(range=[-t, t]),
+            zaxis=dict(range=[-t*factor, t]),
+            xaxis_title='X',
+            yaxis_title='Y',
+            zaxis_title='Z'
+        )
+    )
+
+    wandb.log({
+        'camera_positions': fig,
+        'rgb_gt': wandb.Image(
+            train_set.testimg.numpy(),
+            caption='Ground Truth RGB'
+        )
+    })
+
+def log_frame(
+        metrics: dict,
+        rgb: Tensor,
+        depth: Tensor,
+        ready: torch.cuda.Event
+) -> None:
+    """
+    Logs metrics along with a rendered frame to wandb once the frame has been
+    copied to host memory.
+    ----------------------------------------------------------------------------
+    Args:
+        metrics (dict): scalar metrics
+        rgb (Tensor): [H, W, 3]. Rendered image in host memory
+        depth (Tensor): [H, W, 3]. Colormapped depth in host memory
+        ready (torch.cuda.Event): event recorded after the host copies
+    """
+    ready.synchronize()
+    wandb.log({
+        **metrics,
+        'rgb': wandb.Image(rgb.numpy(), caption='RGB'),
+        'depth': wandb.Image(depth.numpy(), caption='Depth')
+    })
+
 # TRAINING FUNCTIONS
 
 def validation(
@@ -110,10 +247,11 @@ def validation(
         model: nn.Module,
         estimator: OccGridEstimator,
         lpips_net: LPIPS,
-        val_loader: DataLoader,
+        val_set: Dataset,
         chunksize: int,
         device: torch.device,
         render_step_size: float = 5e-3,
+        alpha_thre: float = 1e-2
 ) -> Tuple[float, float, float]:
     """
     Performs validation step for NeRF-like model.
@@ -122,75 +260,75 @@ def validation(
         model (nn.Module): NeRF-like model
         estimator (OccGridEstimator): occupancy grid estimator
         lpips_net (LPIPS): LPIPS network
-        val_loader (DataLoader): data loader
+        val_set (Dataset): validation set of images
         chunksize (int): size of chunks for rendering frames
         device (torch.device): device to be used
         render_step_size (float, optional): step size for rendering
+        alpha_thre (float, optional): opacity threshold for skipping samples
     Returns:
         val_psnr (float): validation PSNR
         val_ssim (float): validation SSIM
         val_lpips (float): validation LPIPS
     """
-    H, W, focal = hwf
-    ndc = val_loader.dataset.ndc
-    rgbs = []
-    rgbs_gt = []
-    for val_data in val_loader:
-        rgb_gt, pose = val_data
-        rgbs_gt.append(rgb_gt) # append ground truth rgb
-        rgb, _ = R.render_frame(
-                hwf,
-                val_loader.dataset.near,
-                val_loader.dataset.far,
-                pose[0],
-                chunksize,
-                estimator,
-                model,
-                train=False,
-                ndc=ndc,
-                white_bkgd=args.white_bkgd,
-                render_step_size=render_step_size,
-                device=device,
-        )
-        rgbs.append(rgb) # append rendered rgb
+    # copy ground truth asynchronously, overlapping with rendering
+    copy_stream = torch.cuda.Stream(device) # side stream for H2D copies
+    with torch.cuda.stream(copy_stream):
+        rgbs_gt = val_set.imgs.to(device, non_blocking=True)
+    rgbs_gt.record_stream(torch.cuda.current_stream(device))
+
+    # render all validation frames at once
+    rgbs, _ = R.render_frames(
+            hwf,
+            val_set.near,
+            val_set.far,
+            val_set.poses,
+            chunksize,
+            estimator,
+            model,
+            train=False,
+            ndc=val_set.ndc,
+            white_bkgd=args.white_bkgd,
+            render_step_size=render_step_size,
+            alpha_thre=alpha_thre,
+            device=device,
+    )
+
+    # wait for pending ground truth copies
+    torch.cuda.current_stream(device).wait_stream(copy_stream)
 
     # compute PSNR
-    rgbs = torch.permute(torch.stack(rgbs, dim=0), (0, 3, 1, 2))
-    rgbs_gt = torch.permute(torch.cat(rgbs_gt, dim=0), (0, 3, 1, 2))
-    rgbs_gt = rgbs_gt.to(device)
+    rgbs = torch.permute(rgbs, (0, 3, 1, 2))
+    rgbs_gt = torch.permute(rgbs_gt, (0, 3, 1, 2))
     val_psnr = -10. * torch.log10(F.mse_loss(rgbs, rgbs_gt))
-    val_size = len(val_loader)
-
-    # compute LPIPS
-    '''if val_size < 25:
-        val_lpips = lpips_net(rgbs, rgbs_gt).mean()
-    else:
-        # compute LPIPS in chunks
-        n_chunks = 5
-        chunk_size = val_size //  n_chunks
-        chunk_idxs = [i for i in range(0, val_size, chunk_size)]
-        chunks = [(rgbs[i:i+chunk_size], rgbs_gt[i:i+chunk_size]) 
-                  for i in chunk_idxs]
+    val_size = len(val_set)
+
+    # compute LPIPS in chunks, the last chunk may be smaller
+    chunk_size = val_size if val_size < 25 else val_size // 5
+    chunks = torch.split(rgbs, chunk_size)
+    with torch.autocast(device.type, dtype=torch.float16):
+        # ground truth features are computed once per validation set
+        if val_set not in lpips_cache:
+            lpips_cache[val_set] = [
+                    lpips_features(lpips_net, chunk_gt) 
+                    for chunk_gt in torch.split(rgbs_gt, chunk_size)
+            ]
+        feats_gt = lpips_cache[val_set]
         val_lpips = 0.
-        for chunk, chunk_gt in chunks:
-            val_lpips += lpips_net(chunk, chunk_gt).mean()
-        val_lpips /= n_chunks'''
-    val_lpips = None
-
-    # compute SSIM
-    rgbs = torch.permute(rgbs, (0, 2, 3, 1)).cpu().numpy()
-    rgbs_gt = torch.permute(rgbs_gt, (0, 2, 3, 1)).cpu().numpy()
-    ssims = np.zeros((rgbs.shape[0],))
-    val_ssim = 0.
-    for rgb, rgb_gt in zip(rgbs, rgbs_gt):
-        val_ssim += SSIM(
-                rgb, 
-                rgb_gt, 
-                channel_axis=-1, 
-                data_range=1.,
-                gaussian_weights=True
-        )
-    val_ssim /= len(rgbs)
+        for chunk, chunk_feats_gt in zip(chunks, feats_gt):
+            feats = lpips_features(lpips_net, chunk)
+            val_lpips += lpips_distance(lpips_net, feats, chunk_feats_gt).sum()
+        val_lpips /= val_size
+    val_lpips = float(val_lpips)
+
+    # compute SSIM for the whole batch on device
+    val_ssim = SSIM(
+            rgbs,
+            rgbs_gt,
+            gaussian_kernel=True,
+            sigma=1.5,
+            kernel_size=11,
+            data_range=1.
+    ).item()
 
     return val_psnr, val_ssim, val_lpips
 
@@ -198,9 +336,11 @@ def train(
         model: nn.Module,
         estimator: OccGridEstimator,
         lpips_net: LPIPS,
-        train_loader: DataLoader,
-        val_loader: DataLoader,
+        train_set: Dataset,
+        val_set: Dataset,
         render_step_size: float = 5e-3,
+        alpha_thre: float = 1e-2,
+        model_path: Optional[str] = None,
         device: torch.device = torch.device('cpu'),
 ) -> Tuple[float, float]:
     """Train NeRF model.
@@ -209,23 +349,32 @@ def train(
         model (nn.Module): NeRF model
         estimator (OccGridEstimator): occupancy grid estimator
         lpips_net (LPIPS): LPIPS network
-        train_loader (DataLoader): training set loader
-        val_loader (DataLoader): validation set loader
+        train_set (Dataset): training set of rays
+        val_set (Dataset): validation set of images
         render_step_size (float, optional): step size for rendering
+        alpha_thre (float, optional): opacity threshold for skipping samples
+        model_path (str, optional): checkpoint path saved at every validation
         device (torch.device): device to train on
     Returns:
         Tuple[float, float, float]: validation PSNR, SSIM, LPIPS
     ----------------------------------------------------------------------------
     """
     # retrieve camera intrinsics
-    hwf = train_loader.dataset.hwf
+    hwf = train_set.hwf
     H, W, focal = hwf
-    testpose = train_loader.dataset.testpose
-    ndc = train_loader.dataset.ndc
+    testpose = train_set.testpose
+    ndc = train_set.ndc
+
+    # keep this rank's shard of training rays on device, sample batches by index
+    rays = train_set.rays[:, rank::world_size].to(device) # [6, N]
+    rgbs = train_set.rgb[:, rank::world_size].to(device) # [3, N] 8-bit colors
+    n_rays = rays.shape[1]
 
     # set up optimizer and scheduler
     params = list(model.parameters())
-    optimizer = torch.optim.Adam(params, lr=args.lro)
+    lro = args.lro * world_size # effective batch grows with the number of ranks
+    # fused kernel updates all parameters at once on CUDA
+    optimizer = torch.optim.Adam(params, lr=lro, fused=device.type == 'cuda')
     sc_dict = {
             'const': (S.Constant, {}),
             'exp': (S.ExponentialDecay, {'r': args.decay_rate})
@@ -234,7 +383,7 @@ def train(
     scheduler = class_name(
             optimizer,
             args.n_iters,
-            args.lro,
+            lro,
             **kwargs
     )
     '''n_iters = args.n_iters
@@ -246,41 +395,71 @@ def train(
                         n_iters * 9 // 10], 
             gamma=0.33
     )'''
-    pbar = tqdm(range(args.n_iters), desc=f"[NeRF]") # set up progress bar
-    iterator = iter(train_loader) # data iterator
+    # set up progress bar
+    pbar = tqdm(range(args.n_iters), desc=f"[NeRF]", disable=rank > 0)
 
     # occlusion regularizer
     if args.beta is not None:
         occ_reg = L.OcclusionRegularizer(args.a, args.b, args.func)
 
     alpha = args.ao
+    psnr_buf = [] # training PSNR of iterations since the last logging step
+    # frequency regularizer, applied for the first Ts iterations
+    Ts = int(args.reg_ratio * args.Td) if alpha is not None else 0
+    if alpha is not None:
+        freq_reg_fn = L.FrequencyRegularizer(model, args.reg)
+
+    # data parallel training forward pass, gradients are averaged across ranks
+    ddp_net = DDP(model, device_ids=[device.index]) if world_size > 1 else model
+    # compiled forward passes, number of samples varies every step. Occupancy
+    # updates run on rank 0 alone and bypass the data parallel wrapper
+    net = torch.compile(model, dynamic=True) if args.compile else model
+    if args.compile:
+        ddp_net = torch.compile(ddp_net, dynamic=True) if world_size > 1 else net
+
+    # optional mixed precision forward pass, bf16 needs no loss scaling
+    bf16 = args.amp and device.type == 'cuda' and torch.cuda.is_bf16_supported()
+
+    # occupancy evaluation skips cells that stay empty after warmup
+    occ_update_rate = 16 # iterations between occupancy grid updates
+    occ_eval_fn = R.OccupancyEvaluator(
+            net,
+            estimator,
+            render_step_size,
+            occ_thre=1e-2,
+            n=occ_update_rate,
+            autocast=bf16
+    )
+
     for k in pbar: # loop over the number of iterations
         model.train()
         estimator.train()
-        # get next batch of data
-        try:
-            rays_o, rays_d, rgb_gt = next(iterator)
-        except StopIteration:
-            iterator = iter(train_loader)
-            rays_o, rays_d, rgb_gt = next(iterator)
+        # release old gradients before the forward pass
+        optimizer.zero_grad(set_to_none=True)
+        # sample random batch of rays
+        idx = torch.randint(0, n_rays, (args.batch_size,), device=device)
+        rays_o = rays[:3, idx].T.contiguous()
+        rays_d = rays[3:, idx].T.contiguous()
+        rgb_gt = rgbs[:, idx].T.float().mul_(1. / 255.)
 
         # render rays
-        (rgb, *_, extras), ray_indices, t_vals = R.render_rays(
-                rays_o=rays_o,
-                rays_d=rays_d,
-                estimator=estimator,
-                model=model,
-                train=True,
-                white_bkgd=args.white_bkgd,
-                render_step_size=render_step_size,
-                device=device
-        )
+        with torch.autocast(device.type, dtype=torch.bfloat16, enabled=bf16):
+            (rgb, *_, extras), ray_indices, t_vals = R.render_rays(
+                    rays_o=rays_o,
+                    rays_d=rays_d,
+                    estimator=estimator,
+                    model=ddp_net,
+                    train=True,
+                    white_bkgd=args.white_bkgd,
+                    render_step_size=render_step_size,
+                    alpha_thre=alpha_thre,
+                    device=device
+            )
         
         # compute loss and PSNR
-        rgb_gt = rgb_gt.to(device)
         loss = F.mse_loss(rgb, rgb_gt)
-        with torch.no_grad():
-            psnr = -10. * torch.log10(loss).item()
+        # keep PSNR on device to avoid a sync every iteration
+        psnr_buf.append(-10. * torch.log10(loss.detach()))
 
         # occlusion regularization
         if args.beta is not None:
@@ -289,45 +468,38 @@ def train(
                 loss += occ_reg(sigmas, t_vals, ray_indices)
 
         # weight decay regularization
-        if alpha is not None:
-            freq_reg = torch.tensor(0.).to(device)
-            # linear decay schedule
-            Ts = int(args.reg_ratio * args.Td)
-            if k < Ts:
-                for name, param in model.named_parameters():
-                    if 'weight' in name and param.shape[0] > 3:
-                        if args.reg == 'l1':
-                            freq_reg += torch.abs(param).sum()
-                        else:
-                            freq_reg += torch.square(param).sum().sqrt()
-
-                loss += alpha * freq_reg
+        if alpha is not None and k < Ts:
+            loss += alpha * freq_reg_fn()
 
         # backpropagate loss
         loss.backward()
         optimizer.step()
         scheduler.step()
-        optimizer.zero_grad()
-
-        # define occupancy evaluation function
-        def occ_eval_fn(x):
-            density = model(x)
-            return density * render_step_size
-
-        # update occupancy grid
-        estimator.update_every_n_steps(
-                step=k,
-                occ_eval_fn=occ_eval_fn,
-                occ_thre=1e-2
-        )
 
-        # log metrics
-        if not args.debug and k % args.val_rate != 0:
-            wandb.log({
-                'train_psnr': psnr,
-                'lr': scheduler.lr,
-                'alpha': alpha
-            })
+        # update occupancy grid on rank 0 and share it with the other ranks
+        if rank == 0:
+            estimator.update_every_n_steps(
+                    step=k,
+                    occ_eval_fn=occ_eval_fn,
+                    occ_thre=1e-2,
+                    n=occ_update_rate
+            )
+        if world_size > 1 and k % occ_update_rate == 0:
+            dist.broadcast(estimator.occs, src=0)
+            dist.broadcast(estimator.binaries, src=0)
+
+        # log metrics averaged since the last logging step
+        compute_val = k % args.val_rate == 0 and k > 0 and args.val
+        compute_val = compute_val and rank == 0
+        if k % args.val_rate == 0:
+            psnr = torch.stack(psnr_buf).mean().item()
+            psnr_buf.clear()
+            if not args.debug and not compute_val and rank == 0:
+                log_async(wandb.log, {
+                    'train_psnr': psnr,
+                    'lr': scheduler.lr,
+                    'alpha': alpha
+                })
 
         # toggle ensemble
         if args.model == 'ensemble':
@@ -336,18 +508,17 @@ def train(
                 m += 1
 
         # compute validation
-        compute_val = k % args.val_rate == 0 and k > 0 and args.val
         if compute_val:
             model.eval()
             estimator.eval()
-            #lpips_net.eval()
+            lpips_net.eval()
             with torch.no_grad():
                 val_metrics = validation(
                         hwf,
                         model,
                         estimator,
                         lpips_net,
-                        val_loader,
+                        val_set,
                         2*args.batch_size,
                         device
                 )
@@ -355,8 +526,8 @@ def train(
                 # render test image
                 rgb, depth = R.render_frame(
                         hwf,
-                        train_loader.dataset.near,
-                        train_loader.dataset.far,
+                        train_set.near,
+                        train_set.far,
                         testpose,
                         2*args.batch_size,
                         estimator,
@@ -365,37 +536,63 @@ def train(
                         ndc=ndc,
                         white_bkgd=args.white_bkgd,
                         render_step_size=render_step_size,
+                        alpha_thre=alpha_thre,
                         device=device
                 )
 
-                # log data to wandb
+                # log data to wandb without stalling training
                 if not args.debug:
-                    wandb.log({
+                    rgb = rgb.to('cpu', non_blocking=True)
+                    # colormap on device, only 8-bit colors are copied
+                    depth = PL.apply_colormap_lut(depth)
+                    depth = depth.to('cpu', non_blocking=True)
+                    ready = torch.cuda.Event()
+                    ready.record()
+                    metrics = {
                         'train_psnr': psnr,
                         'lr': scheduler.lr,
                         'alpha': alpha,
                         'val_psnr': val_psnr,
                         'val_ssim': val_ssim,
-                        'val_lpips': val_lpips,
-                        'rgb': wandb.Image(
-                            rgb.cpu().numpy(),
-                            caption='RGB'
-                        ),
-                        'depth': wandb.Image(
-                            PL.apply_colormap(depth.cpu().numpy()),
-                            caption='Depth'
-                        )
-                    })
+                        'val_lpips': val_lpips
+                    }
+                    log_async(log_frame, metrics, rgb, depth, ready)
+
+            # checkpoint model along with its occupancy grid
+            if model_path is not None:
+                torch.save({
+                    'model': model.state_dict(),
+                    'estimator': estimator.state_dict()
+                }, model_path)
     return
 
 def main():
+    # fail early if there is no model to render from
+    if args.render_only and (args.ckpt is None or not os.path.isfile(args.ckpt)):
+        raise FileNotFoundError(
+                f"--render_only needs an existing checkpoint given by --ckpt, "
+                f"got {args.ckpt}"
+        )
+    # torch.compile supports Python 3.11 starting with torch 2.1
+    if args.compile and sys.version_info >= (3, 11) and torch.__version__ < '2.1':
+        raise RuntimeError(
+                f"--compile needs torch>=2.1 on Python 3.11+, "
+                f"found torch {torch.__version__}"
+        )
+
     # select device
-    device = torch.device(f'cuda' if torch.cuda.is_available() else 'cpu')
+    if world_size > 1:
+        # one process per GPU, launched with torchrun
+        dist.init_process_group('nccl')
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device(f'cuda' if torch.cuda.is_available() else 'cpu')
 
     # print device info or abort if no CUDA device available
     print(f"Device: {torch.cuda.get_device_name(device)}")
 
-    if not args.debug:
+    if not args.debug and rank == 0:
         wandb.login()
         # set up wandb run to track training
         name = f"{args.model}"
@@ -407,11 +604,31 @@ def main():
             config=args
         )
 
+        # build base path for output directories
+        out_dir = os.path.normpath(
+                os.path.join(
+                    args.out_dir, 
+                    args.model, 
+                    args.dataset,
+                    args.scene,
+                    f"n_imgs_{str(args.n_imgs)}",
+                    run.id
+                )
+        )
+
+        # create output directories
+        folders = ['video', 'model']
+        [os.makedirs(os.path.join(out_dir, f), exist_ok=True) for f in folders]
+        model_path = os.path.join(out_dir, 'model', 'nn.pt')
+    else:
+        out_dir, model_path = None, None
+
     # training/validation datasets
     dataset_dict = {
             'synthetic': 
                 (D.SyntheticRealistic, 
-                {'white_bkgd': args.white_bkgd}),
+                {'white_bkgd': args.white_bkgd,
+                 'cache': args.cache_imgs}),
             'llff': 
                 (D.LLFF, 
                 {'factor': args.factor, 
@@ -436,71 +653,32 @@ def main():
             img_mode=True,
             **dataset_kwargs
     )
-    # data loader(s)
-    train_loader = DataLoader(
-            train_set,
-            batch_size=args.batch_size,
-            shuffle=True,
-            num_workers=8
-    )
-    val_loader = DataLoader(
-            val_set,
-            batch_size=1,
-            shuffle=True,
-            num_workers=8
-    )
-    # log interactive 3D plot of camera positions
-    fig = go.Figure(
-            data=[go.Scatter3d(
-                x=train_set.poses[:, 0, 3],
-                y=train_set.poses[:, 1, 3],
-                z=train_set.poses[:, 2, 3],
-                mode='markers',
-                marker=dict(size=7, opacity=0.8, color='red'),
-            )],
-            layout=go.Layout(
-                margin=dict(l=20,r=20, t=20, b=20),
-            )
-    )
-    # set fixed axis scales
-    t = 1 if args.dataset == 'llff' else 5
-    factor = 1 if args.dataset == 'llff' else 0
-    fig.update_layout(
-        scene=dict(
-            xaxis=dict(range=[-t, t]),
-            yaxis=dict(range=[-t, t]),
-            zaxis=dict(range=[-t*factor, t]),
-            xaxis_title='X',
-            yaxis_title='Y',
-            zaxis_title='Z'
-        )
-    )
-
-    if not args.debug:
-        wandb.log({
-            'camera_positions': fig,
-            'rgb_gt': wandb.Image(
-                train_set.testimg.numpy(),
-                caption='Ground Truth RGB'
-            )
-        })
+    # log camera positions in the background
+    if not args.debug and rank == 0:
+        log_async(log_cameras, train_set)
 
     if not args.render_only:
         # initialize modules
         model, estimator, lpips_net = init_models(train_set.aabb)
         model.to(device)
         estimator.to(device)
-        #lpips_net.to(device)
+        lpips_net.to(device)
         # train model
         train(
                 model, 
                 estimator,
                 lpips_net,
-                train_loader,
-                val_loader,
+                train_set,
+                val_set,
+                model_path=model_path,
                 device=device
         )
-        # final validation set and loader
+        if world_size > 1:
+            # evaluation and rendering run on rank 0 only
+            dist.destroy_process_group()
+            if rank > 0:
+                return
+        # final validation set
         val_set = dataset_name(
                 args.scene,
                 'val',
@@ -508,12 +686,6 @@ def main():
                 img_mode=True,
                 **dataset_kwargs
         )
-        val_loader = DataLoader(
-                val_set,
-                batch_size=1,
-                shuffle=True,
-                num_workers=8
-        )
         # compute final validation metrics
         model.eval()
         estimator.eval()
@@ -524,7 +696,7 @@ def main():
                     model,
                     estimator,
                     lpips_net,
-                    val_loader,
+                    val_set,
                     2*args.batch_size,
                     device
             )
@@ -532,35 +704,26 @@ def main():
         final_psnr, final_ssim, final_lpips = val_metrics
         
         if not args.debug:
-            wandb.log({
+            log_async(wandb.log, {
                 'final_psnr': final_psnr,
                 'final_ssim': final_ssim,
                 'final_lpips': final_lpips
             })
     else:
-        model = init_models()
-        # load model
-        model.load_state_dict(torch.load(out_dir + '/model/nn.pt'))
-
-    if not args.debug:
-        # build base path for output directories
-        out_dir = os.path.normpath(
-                os.path.join(
-                    args.out_dir, 
-                    args.model, 
-                    args.dataset,
-                    args.scene,
-                    f"n_imgs_{str(args.n_imgs)}",
-                    run.id
-                )
-        )
-
-        # create output directories
-        folders = ['video', 'model']
-        [os.makedirs(os.path.join(out_dir, f), exist_ok=True) for f in folders]
-        # save model
-        if not args.render_only:
-            torch.save(model.state_dict(), out_dir + '/model/nn.pt')
+        model, estimator, _ = init_models(train_set.aabb, with_lpips=False)
+        model.to(device)
+        estimator.to(device)
+        # load model and occupancy grid from a previous run
+        ckpt = torch.load(args.ckpt, map_location=device)
+        model.load_state_dict(ckpt['model'])
+        estimator.load_state_dict(ckpt['estimator'])
+
+    # save model along with its occupancy grid
+    if not args.debug and not args.render_only:
+        torch.save({
+            'model': model.state_dict(),
+            'estimator': estimator.state_dict()
+        }, model_path)
 
     # compute path poses for video output
     path_poses = train_set.path_poses
@@ -578,6 +741,7 @@ def main():
             estimator,
             ndc=train_set.ndc,
             white_bkgd=args.white_bkgd,
+            alpha_thre=1e-2,
             device=device
     )
     frames, d_frames = output
@@ -590,10 +754,13 @@ def main():
                 d_frames=d_frames
         )
         # log final video renderings to wandb
-        wandb.log({
+        log_async(wandb.log, {
             'rgb_video': wandb.Video(f'{out_dir}/video/rgb.mp4', fps=30),
             'depth_video': wandb.Video(f'{out_dir}/video/depth.mp4', fps=30)
         })
 
+    # wait for pending logs
+    log_pool.shutdown(wait=True)
+
 if __name__ == '__main__':
     main()
@@ -75,6 +75,10 @@ def config_parser() -> argparse.Namespace:
             '--white_bkgd', action="store_true",
             help="Use white background for training imgs"
     )
+    parser.add_argument(
+            '--cache_imgs', action="store_true",
+            help="Cache decoded images in the dataset folder for later runs"
+    )
 
     # args for llff dataset
     parser.add_argument(
@@ -120,6 +124,14 @@ def config_parser() -> argparse.Namespace:
             '--scheduler', choices=['const', 'exp'], default='exp',
             help='Learning rate scheduler'
     )
+    parser.add_argument(
+            '--compile', action='store_true',
+            help='If set, compile model forward pass with torch.compile'
+    )
+    parser.add_argument(
+            '--amp', action='store_true',
+            help='If set, train with bfloat16 mixed precision on supported GPUs'
+    )
 
     #-------------------------------validation---------------------------------#
 
@@ -189,6 +201,10 @@ def config_parser() -> argparse.Namespace:
             '--render_only', action='store_true',
             help='If set, load pretrained model to render video'
     )
+    parser.add_argument(
+            '--ckpt', default=None, type=str,
+            help='Model checkpoint of a previous run, required by --render_only'
+    )
 
     args = parser.parse_args()
 
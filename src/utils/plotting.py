@@ -1,4 +1,5 @@
 # stdlib imports
+from functools import lru_cache
 from typing import Tuple, List, Union, Callable
 
 # third-party imports
@@ -11,6 +12,8 @@ import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import numpy as np
 from numpy import ndarray
+import torch
+from torch import Tensor
 
 def density_animate(
         curves1: np.array,
@@ -75,3 +78,43 @@ def apply_colormap(
         norm = Normalize(vmin=0., vmax=6.)
     # apply the colormap
     return cmap(norm(data))
+
+
+@lru_cache(maxsize=8)
+def colormap_lut(cmap: str, device: torch.device) -> Tensor:
+    """Builds a 256-entry RGB lookup table for a colormap.
+    ----------------------------------------------------------------------------
+    Args:
+        cmap (str): The name of the colormap to use
+        device (torch.device): Device to store the table on
+    Returns:
+        Tensor: [256, 3]. 8-bit RGB colors
+    ----------------------------------------------------------------------------
+    """
+    colors = plt.get_cmap(cmap)(np.linspace(0., 1., 256))[:, :3]
+    lut = np.round(255. * colors).astype(np.uint8)
+
+    return torch.from_numpy(lut).to(device)
+
+def apply_colormap_lut(
+        data: Tensor,
+        cmap: str = 'plasma',
+        vmin: float = 0.,
+        vmax: float = 6.
+) -> Tensor:
+    """Apply a colormap to the data on its own device through a lookup table.
+    ----------------------------------------------------------------------------
+    Args:
+        data (Tensor): The data to apply the colormap to
+        cmap (str): The name of the colormap to use
+        vmin (float): Value mapped to the first color
+        vmax (float): Value mapped to the last color
+    Returns:
+        Tensor: [..., 3]. 8-bit RGB data with the colormap applied
+    ----------------------------------------------------------------------------
+    """
+    lut = colormap_lut(cmap, data.device)
+    # quantize data into table bins as matplotlib does
+    idx = (data - vmin).mul_(256. / (vmax - vmin)).clamp_(0., 255.).long()
+
+    return lut[idx]
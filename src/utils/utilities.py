@@ -1,4 +1,5 @@
 # stdlib modules
+from functools import lru_cache
 import os
 from typing import Optional, Tuple, List, Union, Callable
 
@@ -12,6 +13,13 @@ from torch import Tensor
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import axes3d
 
+# optional modules
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
 def save_origins_and_dirs(poses):
     '''Plot and save optical axis positions and orientations for each camera pose.
     Args:
@@ -33,33 +41,26 @@ def save_origins_and_dirs(poses):
 
 # RAY HELPERS
 
-def get_rays(
-        pose: Tensor,
-        hwf: Tuple[int, int, float],
-        device: torch.device = torch.device('cpu'),
-) -> Tuple[Tensor, Tensor]:
+@lru_cache(maxsize=8)
+def get_dirs(H: int, W: int, focal: float) -> Tensor:
     """
-    Computes ray origins and directions in world coordinates for a given camera 
-    pose.
+    Computes normalized ray directions in camera coordinates for every pixel. 
+    Results are cached per set of intrinsics and must not be modified in place.
     ----------------------------------------------------------------------------
     Args:
-        pose: [4, 4]. Camera pose matrix.
-        hwf: [3]. Height, width, focal length.
-        device: Device to use for computation.
+        H: Image height.
+        W: Image width.
+        focal: Focal length.
     Returns:
-        origins_w: [height, width, 3]. Ray origins in world coords.
-        dirs_w: [height, width, 3]. Ray directions in world coords.
+        dirs: [height, width, 3]. Ray directions in camera coords.
     ----------------------------------------------------------------------------
     """
-    H, W, focal = hwf # unpack intrinsics
-    pose = pose.to(device)
     # create grid of coordinates
     i, j = torch.meshgrid(
-            torch.arange(W, dtype=torch.float32).to(device),
-            torch.arange(H, dtype=torch.float32).to(device),
-            indexing='ij'
+            torch.arange(W, dtype=torch.float32),
+            torch.arange(H, dtype=torch.float32),
+            indexing='xy'
     )
-    i, j = torch.transpose(i, -1, -2), torch.transpose(j, -1, -2)
 
     # use pinhole model to map grid into camera space
     f = focal
@@ -69,15 +70,78 @@ def get_rays(
     )
 
     # normalize directions
-    dirs = dirs/torch.norm(dirs, dim=-1, keepdim=True)
+    return dirs/torch.norm(dirs, dim=-1, keepdim=True)
 
-    # apply camera rotation to ray directions
-    dirs_w = torch.sum(
-            dirs[..., None, :] * pose[:3, :3], 
-            axis=-1
-    )
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def build_rays(
+            out: np.ndarray,
+            poses: np.ndarray,
+            H: int,
+            W: int,
+            focal: float
+    ) -> None:
+        """
+        Writes ray origins and normalized directions in world coordinates for
+        a batch of camera poses into a preallocated buffer.
+        ------------------------------------------------------------------------
+        Args:
+            out: [N, height, width, 6]. Output buffer for origins and dirs.
+            poses: [N, 3+, 4]. Camera pose matrices.
+            H: Image height.
+            W: Image width.
+            focal: Focal length.
+        ------------------------------------------------------------------------
+        """
+        for m in prange(poses.shape[0] * H * W):
+            n, h, w = m // (H * W), (m // W) % H, m % W
+            # pinhole direction in camera space
+            dx = (w - W*0.5) / focal
+            dy = -(h - H*0.5) / focal
+            norm = np.sqrt(dx*dx + dy*dy + 1.)
+            dx, dy, dz = dx / norm, dy / norm, -1. / norm
+            # rotate into world space and copy camera center
+            for r in range(3):
+                out[n, h, w, r] = poses[n, r, 3]
+                out[n, h, w, 3 + r] = (poses[n, r, 0] * dx 
+                                       + poses[n, r, 1] * dy 
+                                       + poses[n, r, 2] * dz)
+
+def get_rays(
+        pose: Tensor,
+        hwf: Tuple[int, int, float],
+        device: torch.device = torch.device('cpu'),
+) -> Tuple[Tensor, Tensor]:
+    """
+    Computes ray origins and directions in world coordinates for a given camera 
+    pose or batch of camera poses.
+    ----------------------------------------------------------------------------
+    Args:
+        pose: [..., 4, 4]. Camera pose matrix.
+        hwf: [3]. Height, width, focal length.
+        device: Device to use for computation.
+    Returns:
+        origins_w: [..., height, width, 3]. Ray origins in world coords.
+        dirs_w: [..., height, width, 3]. Ray directions in world coords.
+    ----------------------------------------------------------------------------
+    """
+    H, W, focal = hwf # unpack intrinsics
+    if HAS_NUMBA and pose.dim() == 3 and torch.device(device).type == 'cpu':
+        # batched rays on CPU are written by a single parallel kernel
+        poses = np.ascontiguousarray(pose.cpu().numpy(), dtype=np.float32)
+        rays = np.empty((poses.shape[0], int(H), int(W), 6), dtype=np.float32)
+        build_rays(rays, poses, int(H), int(W), float(focal))
+        rays = torch.from_numpy(rays)
+
+        return rays[..., :3], rays[..., 3:]
+
+    pose = pose.to(device)
+    dirs = get_dirs(int(H), int(W), float(focal)).to(device)
+
+    # apply camera rotation to ray directions for all poses at once
+    dirs_w = torch.einsum('...ij,hwj->...hwi', pose[..., :3, :3], dirs)
     # apply camera translation to ray origin
-    origins_w = pose[:3, -1].expand(dirs_w.shape)
+    origins_w = pose[..., None, None, :3, -1].expand(dirs_w.shape)
 
     return origins_w, dirs_w 
 